@@ -110,6 +110,18 @@ int readValue(Pin pin) {
   return value;
 }
 
+void printValues() {
+  // Batched read, e.g. "?13,12,A0" -> "1;0;512"
+  for (int pos = 1; pos + 1 < BUFFER_LEN; pos += 3) {
+    Serial.print(readValue(getPin(pos)));
+    if (commandBuffer[pos + 2] != ',') {
+      break;
+    }
+    Serial.print(';');
+  }
+  Serial.println();
+}
+
 int parseNum(int startPos, int base) {
   int value = 0;
   for (int pos = startPos; pos < BUFFER_LEN; pos++) {
@@ -125,11 +137,22 @@ int parseNum(int startPos, int base) {
 }
 
 void processCommand() {
+  if (commandBuffer[0] == '#') {
+    // Tagged read, e.g. "#07A0?": echo the tag before the reply so it can be matched up
+    Serial.print(commandBuffer[0]);
+    Serial.print(commandBuffer[1]);
+    Serial.print(commandBuffer[2]);
+    memmove(commandBuffer, commandBuffer + 3, BUFFER_LEN - 3);
+  }
   if (commandBuffer[0] == 'R') {
     resetSteppers();
     Serial.println("D");
     return;
   }
+  if (commandBuffer[0] == '?') {
+    printValues();
+    return;
+  }
   Pin pin = getPin(0);
 
   // Set value
@@ -1,18 +1,32 @@
 from abc import ABC, abstractmethod
 from typing import *
-from time import sleep
+from time import monotonic, sleep
+import re
 import chess
 
-from src.hardware.serial_protocol import Serial
+from src.hardware.serial_protocol import Serial, format_port, format_read
+
+
+_MATRIX_REPLY = re.compile(rb'(?:[01]{8};){8}\r?\n?')  # A complete matrix response from the Arduino
+_MATRIX_POLLS = 3  # Times to poll a matrix before giving up on getting a complete response
+_ROW_CELLS = tuple(tuple(bool(row >> j & 1) for j in range(8)) for row in range(256))  # Cells of each row byte
+_SQUARE_NAMES = tuple(f'{chr(ord("a") + i)}{j + 1}' for i in range(8) for j in range(8))  # By 8 * i + j
+_START_PIECES = 0xC3C3C3C3C3C3C3C3  # Bitboard of the starting position, columns 0, 1, 6 and 7 of each row
 
 
 class DigitalOutput:
+    __slots__ = ('_serial', 'port', 'reversed', '_is_on', '_cmd_on', '_cmd_off')
+    _settled_at = 0  # Monotonic time by which outputs switched without waiting will have settled
+
     def __init__(self, serial: Serial, port: int, reversed: bool = False):
         self._serial = serial
         self.port = port
         self.reversed = reversed
         self._is_on = False
-        self._serial.set_mode(port, 'OUTPUT')
+        self._serial.set_mode(port, 'OUTPUT')  # also checks the port
+        port_bytes = format_port(port).encode()
+        self._cmd_on = port_bytes + (b':L' if reversed else b':H') + b'\r'
+        self._cmd_off = port_bytes + (b':H' if reversed else b':L') + b'\r'
         self.turn_off()
 
     @property
@@ -20,18 +34,43 @@ class DigitalOutput:
         return self._is_on
 
     def set(self, turn_on: bool):
-        self._serial.set_value(self.port, turn_on ^ self.reversed)
+        if self._serial.connected:
+            self._serial.bridge.write(self._cmd_on if turn_on else self._cmd_off)
         self._is_on = turn_on
 
-    def turn_on(self):
-        # self.set(True)
-        print('Turn on')
-        sleep(1)
+    def turn_on(self, settle_ms: int = 0, wait: bool = True):
+        """
+        :param settle_ms: how long the output takes to settle once on, in milliseconds
+        :param wait: whether to wait for it to settle now, or leave it to `batch_settle`
+        """
+        self.set(True)
+        self._settle(settle_ms, wait)
+
+    def turn_off(self, settle_ms: int = 0, wait: bool = True):
+        """
+        :param settle_ms: how long the output takes to settle once off, in milliseconds
+        :param wait: whether to wait for it to settle now, or leave it to `batch_settle`
+        """
+        self.set(False)
+        self._settle(settle_ms, wait)
 
-    def turn_off(self):
-        # self.set(False)
-        print('Turn off')
-        sleep(1)
+    @staticmethod
+    def _settle(settle_ms: int, wait: bool):
+        if not settle_ms:
+            return
+        if wait:
+            sleep(settle_ms / 1000)
+        else:
+            DigitalOutput._settled_at = max(DigitalOutput._settled_at, monotonic() + settle_ms / 1000)
+
+    @staticmethod
+    def batch_settle():
+        """
+        Waits once for every output switched without waiting to finish settling
+        """
+        remaining = DigitalOutput._settled_at - monotonic()
+        if remaining > 0:
+            sleep(remaining)
 
     def toggle(self) -> bool:
         self.set(not self.is_on)
@@ -39,9 +78,12 @@ class DigitalOutput:
 
 
 class CachedValue(ABC):
+    __slots__ = ('_serial', '_value', '_fetched', 'last_value', 'track')
+
     def __init__(self, serial: Serial, track: bool = False):
         self._serial = serial
         self._value = None
+        self._fetched = False  # Since _value can itself be None
         self.last_value = None
         self.track = track
 
@@ -52,13 +94,15 @@ class CachedValue(ABC):
 
     @property
     def value(self) -> _type:
-        if self._value is None:
+        if not self._fetched:
             self._value = self._fetch_value()
+            self._fetched = True
         return self._value
 
     def reset(self):
         self.last_value = self.value if self.track else self._value  # poll value if tracking
         self._value = None
+        self._fetched = False
 
     @abstractmethod
     def _fetch_value(self) -> _type:
@@ -66,18 +110,32 @@ class CachedValue(ABC):
 
 
 class DigitalInput(CachedValue):
+    __slots__ = ('port', 'reversed', '_group', '_read_msg')
+
     def __init__(self, serial: Serial, port: int, reversed: bool = False):
         super().__init__(serial)
         self.port = port
         self.reversed = reversed
-        self._serial.set_mode(port, 'INPUT')
+        self._group = None
+        self._serial.set_mode(port, 'INPUT')  # also checks the port
+        self._read_msg = format_read(port)
 
     @property
     def _type(self) -> TypeVar:
         return TypeVar('Digital', bool)
 
     def _fetch_value(self) -> _type:
-        return (self._serial.get_value(self.port) == 1) ^ self.reversed
+        if self._group is not None:
+            value = self._group.value[self.port]
+        else:
+            line = self._serial.query(self._read_msg)
+            value = None if line is None else int(line)
+        return (value == 1) ^ self.reversed
+
+    def reset(self):
+        super().reset()
+        if self._group is not None:
+            self._group.invalidate()  # so the next read sees a fresh batch
 
     def newly(self) -> Optional[bool]:
         if self.last_value is None:
@@ -90,85 +148,221 @@ class DigitalInput(CachedValue):
         return not self.value and self.last_value
 
 
-class DigitalInputMatrix(CachedValue):
+class DeviceGroup(CachedValue):
+    __slots__ = ('inputs', '_resetting')
+
+    def __init__(self, serial: Serial, inputs: Iterable[DigitalInput], track: bool = False):
+        """
+        Polls the given inputs together, with a single batched read per reset.
+        Resetting a single input also drops the batch, so that its next read polls again
+
+        :param serial: the serial the inputs are connected to
+        :param inputs: the inputs to poll together
+        :param track: whether to poll and remember the last value on reset
+        """
+        super().__init__(serial, track=track)
+        self.inputs = tuple(inputs)
+        self._resetting = False
+        for device in self.inputs:
+            device._group = self
+
+    @property
+    def _type(self) -> TypeVar:
+        return TypeVar('DeviceGroup', Dict[Union[str, int], Optional[int]])
+
+    def _fetch_value(self) -> _type:
+        return self._serial.get_values([device.port for device in self.inputs])
+
+    def invalidate(self):
+        """
+        Drops the current batch without resetting the inputs, unless the whole group is being reset
+        """
+        if not self._resetting:
+            self._value = None
+            self._fetched = False
+
+    def reset(self):
+        self._resetting = True  # the members are reset together, so keep the batch until super().reset()
+        try:
+            for device in self.inputs:
+                device.reset()
+        finally:
+            self._resetting = False
+        super().reset()
+
+
+class DigitalInputBitboard(CachedValue):
+    __slots__ = ('port', 'reversed', '_read_msg')
+
     def __init__(self, serial: Serial, port: Union[str, int], reversed: bool = False, track: bool = False):
         super().__init__(serial, track=track)
         self.reversed = reversed
         self.port = port
-        self._serial.set_mode(self.port, 'MATRIX')
+        self._serial.set_mode(self.port, 'MATRIX')  # also checks the port
+        self._read_msg = format_read(port)
 
     @property
     def _type(self) -> TypeVar:
-        return TypeVar('DigitalMatrix', List[List[bool]])
+        return TypeVar('DigitalBitboard', int)
+
+    @property
+    def bitboard(self) -> int:
+        """
+        The current value of the matrix packed into an int, with cell (i, j) at bit 8 * i + j
+        """
+        return self.value
+
+    @property
+    def last_bitboard(self) -> Optional[int]:
+        """
+        The last value of the matrix as a bitboard
+        """
+        return self.last_value
+
+    def _fetch_bitboard(self) -> int:
+        """
+        Polls the matrix from the Arduino, polling again if the response is garbled
+
+        :return: the polled matrix as a bitboard
+        """
+        for _ in range(_MATRIX_POLLS):
+            val = self._serial.query(self._read_msg)
+            if _MATRIX_REPLY.fullmatch(val):
+                break
+        else:
+            raise ValueError(f'Incomplete matrix from {self.port}: {val}')
+        cells = val[:72].replace(b';', b'')
+        bitboard = int(cells[::-1], 2)  # first cell is the lowest bit
+        if self.reversed:
+            bitboard ^= (1 << 64) - 1
+        return bitboard
+
+    @staticmethod
+    def _from_bitboard(bitboard: int) -> _type:
+        """
+        :param bitboard: the bitboard to convert
+        :return: the bitboard in the form of this input's value
+        """
+        return bitboard
 
     def _fetch_value(self) -> _type:
-        val = self._serial.get_value(self.port)
-        res = []
-        for row in val.split(';')[:-1]:
-            res.append([(v == '1') ^ self.reversed for v in row])
-        return res
+        return self._fetch_bitboard()
 
-    def newly(self) -> Optional[List[List[bool]]]:
-        if self.last_value is None:
+    def newly(self) -> _type:
+        if self.last_bitboard is None:
             return None
-        return [[row[j] and not self.last_value[i][j] for j in range(len(row))] for i, row in enumerate(self.value)]
+        return self._from_bitboard(self.bitboard & ~self.last_bitboard)
 
-    def oldly(self) -> Optional[List[List[bool]]]:
-        if self.last_value is None:
+    def oldly(self) -> _type:
+        if self.last_bitboard is None:
             return None
-        return [[not row[j] and self.last_value[i][j] for j in range(len(row))] for i, row in enumerate(self.value)]
+        return self._from_bitboard(self.last_bitboard & ~self.bitboard)
+
+    @staticmethod
+    def _first_cell(bitboard: int) -> Optional[Tuple[int, int]]:
+        """
+        :param bitboard: the bitboard to search
+        :return: the index of the highest cell set in the bitboard, or None if none are
+        """
+        if not bitboard:
+            return None
+        k = bitboard.bit_length() - 1
+        return k >> 3, k & 7
+
+    def first_newly(self) -> Optional[Tuple[int, int]]:
+        """
+        Like `newly`, but only finds one cell, without building the whole result
+
+        :return: the index of a cell that has turned on, or None if none have
+        """
+        if self.last_bitboard is None:
+            return None
+        return self._first_cell(self.bitboard & ~self.last_bitboard)
+
+    def first_oldly(self) -> Optional[Tuple[int, int]]:
+        """
+        Like `oldly`, but only finds one cell, without building the whole result
+
+        :return: the index of a cell that has turned off, or None if none have
+        """
+        if self.last_bitboard is None:
+            return None
+        return self._first_cell(self.last_bitboard & ~self.bitboard)
+
+
+class DigitalInputMatrix(DigitalInputBitboard):
+    __slots__ = ('_bitboard', 'last_bitboard')
+
+    def __init__(self, serial: Serial, port: Union[str, int], reversed: bool = False, track: bool = False):
+        super().__init__(serial, port, reversed=reversed, track=track)
+        self._bitboard = None
+        self.last_bitboard = None
+
+    @property
+    def _type(self) -> TypeVar:
+        return TypeVar('DigitalMatrix', List[List[bool]])
+
+    @property
+    def bitboard(self) -> int:
+        self.value  # poll value if needed
+        return self._bitboard
+
+    @staticmethod
+    def _from_bitboard(bitboard: int) -> _type:
+        return [list(_ROW_CELLS[row]) for row in bitboard.to_bytes(8, 'little')]
+
+    def _fetch_value(self) -> _type:
+        self._bitboard = self._fetch_bitboard()
+        return self._from_bitboard(self._bitboard)
+
+    def reset(self):
+        super().reset()
+        self.last_bitboard = self._bitboard
+        self._bitboard = None
 
 
 class DigitalInputMatrixSet(DigitalInputMatrix):
+    __slots__ = ()
+
     @property
     def _type(self) -> TypeVar:
         return TypeVar('DigitalMatrixSet', Set[Tuple[int, int]])
 
-    def _fetch_value(self) -> _type:
-        val = super()._fetch_value()
+    @staticmethod
+    def _from_bitboard(bitboard: int) -> _type:
         indexes = set()
-        for i, row in enumerate(val):
-            for j, v in enumerate(row):
-                if v:
-                    indexes.add((i, j))
+        while bitboard:
+            k = bitboard.bit_length() - 1
+            indexes.add((k >> 3, k & 7))
+            bitboard ^= 1 << k
         return indexes
 
-    def newly(self) -> Optional[Set[Tuple[int, int]]]:
-        if self.last_value is None:
-            return None
-        return self.value - self.last_value
-
-    def oldly(self) -> Optional[Set[Tuple[int, int]]]:
-        if self.last_value is None:
-            return None
-        return self.last_value - self.value
-
 
 class MoveSensor(CachedValue):
+    __slots__ = ('_matrix', 'pick_up', 'prev_pick_up')
+
     def __init__(self, serial: Serial, port: Union[str, int], reversed: bool = False):
         super().__init__(serial, track=True)
-        self._matrix = DigitalInputMatrixSet(serial, port, reversed=reversed, track=True)
+        self._matrix = DigitalInputBitboard(serial, port, reversed=reversed, track=True)
         self.pick_up = None
         self.prev_pick_up = None
-        self._start = [[j in (0, 1, 6, 7) for j in range(8)] for i in range(8)]
 
     @staticmethod
     def _index_to_move(indexes):
-        res = chr(indexes[0] + ord('a')) + str(indexes[1] + 1)
-        print(indexes, res)
-        return res
+        return _SQUARE_NAMES[indexes[0] * 8 + indexes[1]]
 
     @property
     def _type(self) -> TypeVar:
         return TypeVar('MoveSensor', Optional[chess.Move])
 
     def wait_for_setup(self):
+        last_pieces = None
         while True:
-            pieces = [[False for _ in range(8)] for _ in range(8)]
-            for i, j in self._matrix.value:
-                pieces[i][j] = True
-            print('\n'.join([''.join(['1' if pieces[i][j] else '0' for j in range(8)]) for i in range(8)]), end='\n\n')
-            if pieces == self._start:
+            pieces = self._matrix.bitboard
+            if pieces != last_pieces:  # Only reprint the board when it changes
+                print('\n'.join(f'{row:08b}'[::-1] for row in pieces.to_bytes(8, 'little')), end='\n\n')
+                last_pieces = pieces
+            if pieces == _START_PIECES:
                 return
             sleep(0.5)
             self._matrix.reset()
@@ -176,10 +370,10 @@ class MoveSensor(CachedValue):
     def _fetch_value(self) -> _type:
         if self.pick_up is None:
             return None
-        newly = self._matrix.newly()
-        if len(newly) > 0:
-            print('Piece down: ', end='')
-            set_down = self._index_to_move(list(newly)[0])
+        newly = self._matrix.first_newly()
+        if newly is not None:
+            set_down = self._index_to_move(newly)
+            print(f'Piece down: {set_down}')
             if self.prev_pick_up is None:
                 res = None if set_down == self.pick_up else self.pick_up + set_down
             elif self.pick_up == set_down:
@@ -196,8 +390,8 @@ class MoveSensor(CachedValue):
     def reset(self):
         super().reset()
         self._matrix.reset()
-        oldly = self._matrix.oldly()
-        if len(oldly) > 0:
-            print('Piece up: ', end='')
+        oldly = self._matrix.first_oldly()
+        if oldly is not None:
             self.prev_pick_up = self.pick_up
-            self.pick_up = self._index_to_move(list(oldly)[0])
+            self.pick_up = self._index_to_move(oldly)
+            print(f'Piece up: {self.pick_up}')
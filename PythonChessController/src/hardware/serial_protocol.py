@@ -1,11 +1,24 @@
+from collections import deque
+import functools
+import itertools
+from pathlib import Path
+import sys
+import threading
+import time
 import serial
 import serial.tools.list_ports as list_ports
 from typing import *
 
 
-ARDUINO_IDS = ((0x2341, 0x0043), (0x2341, 0x0001),
-               (0x2A03, 0x0043), (0x2341, 0x0243),
-               (0x0403, 0x6001), (0x1A86, 0x7523))
+ARDUINO_IDS = frozenset({(0x2341, 0x0043), (0x2341, 0x0001),
+                         (0x2A03, 0x0043), (0x2341, 0x0243),
+                         (0x0403, 0x6001), (0x1A86, 0x7523)})
+COMPORTS_TTL = 2  # Seconds to reuse a scan of the serial ports for
+PORT_CACHE = Path.home() / '.pie_chess_port'  # Last port an Arduino was found on
+SETUP_TIMEOUT = 5  # Seconds to wait for a device on the cached port to finish setup
+SETUP_BANNER = 'Setup done.'  # The line the Arduino sends once it has finished setup
+
+_OPEN_PORTS = set()  # Ports held by a Serial in this process
 MODES = {'INPUT': 'I',
          'OUTPUT': 'O',
          'BRAKE': 'S',
@@ -96,6 +109,7 @@ def check_inputs(port: Union[str, int], value: Optional[Union[str, int]] = None,
         raise ValueError(f'Cannot set stepper speed to less than 0 ({mode})')
 
 
+@functools.lru_cache(maxsize=32)
 def format_port(port: Union[str, int]) -> str:
     """
     Properly formats the given port to send to the Arduino.
@@ -113,6 +127,16 @@ def format_port(port: Union[str, int]) -> str:
     return f'{zero}{port}'
 
 
+def format_read(port: Union[str, int]) -> bytes:
+    """
+    Formats a read of the given port to send to the Arduino
+
+    :param port: the port to read
+    :return: the encoded read
+    """
+    return f'{format_port(port)}?'.encode()
+
+
 def hex_str(value: int):
     """
     :param value: a value to convert to hex
@@ -122,6 +146,9 @@ def hex_str(value: int):
     return ('-' if neg else '') + hex(value)[(3 if neg else 2):]
 
 
+HEX_VALUES = tuple(hex_str(value) for value in range(256))  # hex_str of every valid value
+
+
 def format_value(value: Union[bool, int]) -> str:
     """
     Formats the given value to give to the Arduino.
@@ -131,10 +158,12 @@ def format_value(value: Union[bool, int]) -> str:
     :param value: the value to format
     :return: the formatted value
     """
-    if isinstance(value, bool):
-        return 'H' if value else 'L'
+    if value is True:
+        return 'H'
+    elif value is False:
+        return 'L'
     elif isinstance(value, int):
-        return hex_str(value)
+        return HEX_VALUES[value] if 0 <= value < 256 else hex_str(value)
 
 
 def format_mode(mode: Union[str, int]) -> str:
@@ -152,42 +181,191 @@ def format_mode(mode: Union[str, int]) -> str:
         return hex_str(mode)
 
 
+def set_low_latency(bridge: serial.Serial):
+    """
+    Asks the USB-serial driver to pass on received bytes immediately, rather than
+    holding them for its latency timer (16 ms by default on FTDI/CH340 bridges).
+    Does nothing where this isn't supported, such as on Windows, or on boards that
+    use CDC-ACM (e.g. a genuine Uno), which already poll every 1 ms.
+
+    :param bridge: the open serial connection to update
+    """
+    try:
+        bridge.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError, OSError):
+        pass
+
+
+@functools.lru_cache(maxsize=1)
+def _scan_comports(_time_bucket: int) -> Tuple:
+    """
+    :param _time_bucket: only used as the cache key, so scans are reused within a bucket
+    :return: the serial ports currently available
+    """
+    return tuple(list_ports.comports())
+
+
+def comports() -> Tuple:
+    """
+    Lists the available serial ports, reusing the last scan if it is under
+    `COMPORTS_TTL` seconds old, since scanning is slow on Windows
+
+    :return: the serial ports currently available
+    """
+    return _scan_comports(int(time.monotonic() // COMPORTS_TTL))
+
+
 class Serial:
     def __init__(self, port=None):
         """
         :param port: the port to read/write to, or None to find one
         """
+        self._lines = deque()  # Untagged lines from the Arduino, oldest first
+        self._replies = {}  # Tagged replies from the Arduino, by tag
+        self._received = threading.Condition()
+        self._error = None  # Why the reader thread stopped, if it has
+        self._reader = None
+        self._closing = False
+        self._tags = itertools.count()
         if port is None:
             self.bridge = None
             self.connected = False
-            for device in list_ports.comports():
-                if (device.vid, device.pid) in ARDUINO_IDS:
-                    print(f'Found {(device.vid, device.pid)} - device {device.device}')
-                    try:
-                        self.bridge = serial.Serial(device.device, 115200)
-                        self.connected = True
-                        print(f'Connected to {device.device}...')
-                        break
-                    except BaseException as err:
-                        print(err)
-                        pass
+            try:
+                cached = PORT_CACHE.read_text().strip()
+            except OSError:
+                cached = None
+            if cached in _OPEN_PORTS:
+                # Another Serial holds it, so the cache may still be right for the next run
+                self._find_port(remember=False)
+            else:
+                if cached is not None and self._open_cached_port(cached):
+                    return
+                self._find_port()
         else:
             try:
-                self.bridge = serial.Serial(port, 115200)
-                self.connected = True
+                self._open(port)
             except BaseException as err:
                 print(err)
                 self.bridge = None
                 self.connected = False
         self.wait_for_setup()
 
-    def wait_for_setup(self):
+    def _open_cached_port(self, port: str) -> bool:
+        """
+        Tries to reconnect to the port an Arduino was last found on, which is
+        much faster than scanning the ports on Windows.
+        Since another device may have taken over the port, it only counts as
+        connected once it sends the Arduino's setup banner.
+
+        :param port: the port read from `PORT_CACHE`
+        :return: True if connected to an Arduino that has finished setup
+        """
+        try:
+            self._open(port)
+        except (serial.SerialException, OSError, ValueError):
+            return False
+        line = self._read(SETUP_TIMEOUT)
+        if line is not None:
+            print(line)
+        if line is None or line.strip() != SETUP_BANNER:
+            self._close()
+            return False
+        print(f'Connected to {port}...', file=sys.stderr)
+        return True
+
+    def _find_port(self, remember: bool = True):
+        """
+        Scans the ports for an Arduino and connects to the first one that opens,
+        skipping those already held by another Serial
+
+        :param remember: whether to save the port to `PORT_CACHE` for next time
+        """
+        for device in comports():
+            if (device.vid, device.pid) in ARDUINO_IDS and device.device not in _OPEN_PORTS:
+                print(f'Found {(device.vid, device.pid)} - device {device.device}', file=sys.stderr)
+                try:
+                    self._open(device.device)
+                    print(f'Connected to {device.device}...', file=sys.stderr)
+                except BaseException as err:
+                    print(err, file=sys.stderr)
+                    continue
+                if remember:
+                    try:
+                        PORT_CACHE.write_text(device.device)
+                    except OSError:
+                        pass
+                break
+
+    def _open(self, port: str):
+        """
+        Opens the connection to the given port
+
+        :param port: the port to connect to
+        """
+        self.bridge = serial.Serial(port, 115200)
+        self.connected = True
+        _OPEN_PORTS.add(port)
+        set_low_latency(self.bridge)
+        self._closing = False
+        self._error = None
+        self._reader = threading.Thread(target=self._reader_loop, daemon=True)
+        self._reader.start()
+
+    def _close(self):
+        """
+        Closes the connection, stopping the reader thread and dropping anything it had read
+        """
+        self._closing = True
+        self.bridge.cancel_read()
+        self.bridge.close()
+        self._reader.join()
+        _OPEN_PORTS.discard(self.bridge.port)
+        self.bridge = None
+        self.connected = False
+        self._error = None
+        self._lines.clear()
+        self._replies.clear()
+
+    def _reader_loop(self):
+        """
+        Continuously reads from the Arduino, sorting each line it sends into
+        the replies to tagged queries or the untagged lines
+        """
+        buffer = bytearray()
+        while not self._closing:
+            try:
+                buffer += self.bridge.read(self.bridge.in_waiting or 1)
+            except Exception as err:  # Port was closed or disconnected
+                with self._received:
+                    self._error = err
+                    self._received.notify_all()
+                return
+            end = buffer.find(b'\n')
+            while end != -1:
+                line = bytes(buffer[:end + 1])
+                del buffer[:end + 1]
+                with self._received:
+                    if line[:1] == b'#':
+                        self._replies[line[1:3]] = line[3:]
+                    else:
+                        self._lines.append(line)
+                    self._received.notify_all()
+                end = buffer.find(b'\n')
+
+    def wait_for_setup(self, timeout: Optional[float] = None) -> bool:
         """
         Stalls until a line is given from the Arduino.
         Helpful for waiting until the Arduino has finished setup
+
+        :param timeout: the most seconds to wait for, or None to wait forever
+        :return: False if it timed out, or True otherwise
         """
         if self.connected:
-            print(self.bridge.readline().decode())
+            line = self._read(timeout)
+            if line is None:
+                return False
+            print(line)
+        return True
 
     def set_value(self, port: Union[str, int], value: Union[bool, int]):
         """
@@ -232,14 +410,50 @@ class Serial:
         :param port: the port to read from
         :return: the value, from 0-255, of the port
         """
+        line = self.get_raw(port)
+        if line is not None:
+            try:
+                return int(line)  # int() parses the bytes directly
+            except ValueError:
+                return line.decode()
+
+    def get_raw(self, port: Union[str, int]) -> Optional[bytes]:
+        """
+        Gets the undecoded reply from reading the given port
+
+        :param port: the port to read from
+        :return: the Arduino's reply, or None if not connected
+        """
         check_inputs(port)
+        return self.query(format_read(port))
+
+    def query(self, msg: bytes) -> Optional[bytes]:
+        """
+        Sends an already formatted read, such as from `format_read`, without checking it.
+        Meant for devices that check and format their reads once, up front.
+
+        :param msg: the read to send
+        :return: the Arduino's reply, or None if not connected
+        """
         if self.connected:
-            self._write(f'{format_port(port)}?')
-            line = self._read()
-            try:
-                return int(line)
-            except:
-                return line
+            return self._query(msg)
+
+    def get_values(self, ports: Sequence[Union[str, int]]) -> Dict[Union[str, int], Optional[int]]:
+        """
+        Gets the values from all the given ports in a single round trip to the Arduino
+
+        :param ports: the ports to read from
+        :return: a dict from each port to its value, from 0-255, or to None if not connected
+        """
+        for port in ports:
+            check_inputs(port)
+        if not self.connected:
+            return dict.fromkeys(ports)
+        line = self._query(f'?{",".join(format_port(p) for p in ports)}'.encode())
+        values = line.split(b';')
+        if len(values) != len(ports):
+            raise ValueError(f'Expected {len(ports)} values from the Arduino, got {line!r}')
+        return {port: int(value) for port, value in zip(ports, values)}
 
     def reset_steppers(self, ports: Tuple[str, str, int, int]):
         if self.connected:
@@ -257,12 +471,35 @@ class Serial:
         # if ':' in msg:
         #     print(self._read())
 
-    def _read(self) -> str:
+    def _read(self, timeout: Optional[float] = None) -> Optional[str]:
         """
         Waits for an output from the Arduino and returns it
 
-        :return: the Arduino's output
+        :param timeout: the most seconds to wait for, or None to wait forever
+        :return: the Arduino's output, or None if it timed out
         """
-        line = self.bridge.readline().decode()
+        with self._received:
+            self._received.wait_for(lambda: self._lines or self._error is not None, timeout)
+            if not self._lines:
+                if self._error is None:
+                    return None
+                raise self._error
+            line = self._lines.popleft().decode()
         # print(f'Response: {line}')
         return line
+
+    def _query(self, msg: bytes) -> bytes:
+        """
+        Sends a read to the Arduino, tagged so that its reply can be told apart
+        from any other output, and waits for the reply
+
+        :param msg: the read to send
+        :return: the Arduino's reply, without the tag
+        """
+        tag = b'%02d' % (next(self._tags) % 100)
+        self.bridge.write(b'#' + tag + msg + b'\r')
+        with self._received:
+            self._received.wait_for(lambda: tag in self._replies or self._error is not None)
+            if tag not in self._replies:
+                raise self._error
+            return self._replies.pop(tag)
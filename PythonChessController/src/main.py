@@ -5,31 +5,96 @@ from hardware.drive_system import ChessDrive
 from hardware.serial_protocol import Serial
 from hardware.devices import *
 from time import sleep
+import threading
 
 
-def move_from_uci(drive_sys, magnet, move, capture=False):
-    if len(move) == 4:
-        old_rank = ord(move[0]) - ord('a')
-        old_file = int(move[1]) - 1
+def move_piece(drive_sys, magnet, from_square, to_square):
+    old_rank = chess.square_file(from_square)
+    old_file = chess.square_rank(from_square)
 
-        new_rank = ord(move[2]) - ord('a')
-        new_file = int(move[3]) - 1
+    new_rank = chess.square_file(to_square)
+    new_file = chess.square_rank(to_square)
 
-        print(f'Moving to piece at {old_file, old_rank}')
-        drive_sys.move_to((old_file, old_rank))
-        drive_sys.update()
-        print('Moving over')
-        magnet.turn_on()
-        drive_sys.move((0, 0.5))
-        drive_sys.update()
-        print(f'Moving to location {new_file, new_rank}')
-        drive_sys.move_to((new_file - 0.5, new_rank))
-        drive_sys.update()
-        drive_sys.move((0.5, 0))
-        drive_sys.update()
-        magnet.turn_off()
-    else:
-        print('Please enter a start and end square.')
+    print(f'Moving to piece at {old_file, old_rank}')
+    drive_sys.move_to((old_file, old_rank))
+    drive_sys.update()
+    print('Moving over')
+    magnet.turn_on(settle_ms=1000)
+    drive_sys.move((0, 0.5))
+    drive_sys.update()
+    print(f'Moving to location {new_file, new_rank}')
+    drive_sys.move_to((new_file - 0.5, new_rank))
+    drive_sys.update()
+    drive_sys.move((0.5, 0))
+    drive_sys.update()
+    magnet.turn_off(settle_ms=1000)
+
+
+def move_from_uci(drive_sys, magnet, board, move):
+    """
+    Plays the given move on the board and makes it on the physical board.
+    The squares the move touches are found by diffing the occupancy bitboards
+    from before and after the move, which also picks up castling rooks and
+    en passant captures.
+    """
+    color = board.turn
+    before = board.occupied_co[color]
+    opponent = board.occupied_co[not color]
+    board.push(move)
+    after = board.occupied_co[color]
+    vacated = before & ~after
+    filled = after & ~before
+    captured = opponent & ~board.occupied_co[not color]
+
+    if captured:
+        input(f'Please remove the captured piece at {chess.square_name(chess.msb(captured))}, then press enter')
+    move_piece(drive_sys, magnet, move.from_square, move.to_square)
+    vacated &= ~chess.BB_SQUARES[move.from_square]
+    filled &= ~chess.BB_SQUARES[move.to_square]
+    if vacated and filled:  # Castling rook
+        move_piece(drive_sys, magnet, chess.msb(vacated), chess.msb(filled))
+
+
+class Ponder:
+    def __init__(self, engine, board, limit=chess.engine.Limit(time=30), multipv=3, min_depth=12):
+        """
+        Analyses the position in the background while the player thinks, remembering
+        the engine's reply to each of the player's moves it expects
+
+        :param engine: the engine to analyse with
+        :param board: the position the player is to move in
+        :param limit: when to stop analysing if the player hasn't moved yet
+        :param multipv: how many of the player's moves to prepare replies to
+        :param min_depth: the shallowest fully searched depth to trust replies from
+        """
+        self.min_depth = min_depth
+        self.replies = {}  # From the deepest fully searched depth so far
+        self._analysis = engine.analysis(board, limit, multipv=multipv)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        depth, replies = None, {}
+        for info in self._analysis:
+            pv = info.get('pv')
+            if pv is None or len(pv) < 2 or 'depth' not in info:
+                continue
+            if info['depth'] != depth:
+                # the engine has moved on, so the previous depth is fully searched
+                if depth is not None and depth >= self.min_depth:
+                    self.replies = replies
+                depth, replies = info['depth'], {}
+            replies[pv[0]] = pv[1]
+
+    def stop(self):
+        """
+        Stops analysing
+
+        :return: a dict from each expected player move to the engine's reply
+        """
+        self._analysis.stop()
+        self._thread.join()
+        return self.replies
 
 
 def main():
@@ -51,6 +116,8 @@ def main():
 
     # user plays chess against engine
     while not board.is_game_over():
+        # think on the player's time
+        ponder = Ponder(engine, board)
         player_move = None
         while player_move is None:
             player_move = moves.value
@@ -62,11 +129,12 @@ def main():
         print(board)
         print('\n')
 
-        # makes engine's move on the board
-        result = engine.play(board, chess.engine.Limit(time=0.1))
+        # makes engine's move on the board, using the pondered reply if the player moved as expected
+        reply = ponder.stop().get(move)
+        if reply is None:
+            reply = engine.play(board, chess.engine.Limit(time=0.1)).move
         # interface with arduino to move pieces
-        move_from_uci(drive_sys, magnet, result.move.uci(), capture=board.is_capture(result.move))
-        board.push(result.move)
+        move_from_uci(drive_sys, magnet, board, reply)
         # print board after engine move is made
         print(board)
         print('\n')
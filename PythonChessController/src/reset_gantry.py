@@ -10,5 +10,6 @@ if __name__ == '__main__':
     serial.reset_steppers(('S0', 'S2', 13, 12))
     while True:
         # print(serial._read())
-        print(f'X: {serial.get_value(13)}, Y: {serial.get_value(12)}')
+        values = serial.get_values((13, 12))
+        print(f'X: {values[13]}, Y: {values[12]}')
         # sleep(0.1)